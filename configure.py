@@ -9,14 +9,19 @@
 #   python3 configure.py
 #   ninja
 #
+# Or configure and build in one step:
+#   python3 configure.py --build
+#
 # Append --help to see available options.
 ###
 
 import argparse
+import os
 import sys
 from enum import IntEnum
 from pathlib import Path
-from typing import Any, Dict, List
+from types import MappingProxyType
+from typing import Any, Dict, List, Mapping, NamedTuple, Tuple
 
 from tools.project import (
     Object,
@@ -27,6 +32,8 @@ from tools.project import (
     is_windows,
 )
 
+IS_WINDOWS = is_windows()
+
 # Game versions
 DEFAULT_VERSION = 2  # BBA: WD has a debug linker map - target that primarily
 VERSIONS = [
@@ -44,126 +51,63 @@ VERSIONS = [
     "RZTE01",  # Wii Sports Resort (USA, Rev 1)
     "SOUE01",  # The Legend of Zelda: Skyward Sword (USA, Rev 0)
 ]
+VERSION_INDICES = {version: i for i, version in enumerate(VERSIONS)}
+
+# Per-version configuration directory root
+CONFIG_DIR = Path("config")
 
 
 class EGGApp(IntEnum):
-    OGWS = VERSIONS.index("RSPE01")
-    WP = VERSIONS.index("RHAE01")
-    BBA_WD = VERSIONS.index("RYWE01")
-    MKW = VERSIONS.index("RMCP01")
-    WF = VERSIONS.index("RFNE01")
-    WM = VERSIONS.index("R64E01")
-    AC_CF = VERSIONS.index("RUUE01")
-    PIKMIN1 = VERSIONS.index("R9IE01")
-    PIKMIN2 = VERSIONS.index("R92E01")
-    WFP = VERSIONS.index("RFPE01")
-    NSMBW = VERSIONS.index("SMNP01")
-    WSR = VERSIONS.index("RZTE01")
-    LOZ_SS = VERSIONS.index("SOUE01")
-
-
-# Specifies year/month for EGG_VERSION per game
-def get_build_version_number(version_num: int) -> str:
-    match version_num:
-        case EGGApp.OGWS:
-            return "200611L"
-        case EGGApp.WP:
-            return "200702L"
-        case EGGApp.BBA_WD:
-            return "200704L"
-        case EGGApp.MKW:
-            return "200804L"
-        case EGGApp.WF:
-            return "200805L"
-        case EGGApp.WM:
-            return "200810L"
-        case EGGApp.AC_CF:
-            return "200811L"
-        # Pikmin 2 is weird. It was released in USA in 2012
-        # However, we use the 2009 build date due to it both releasing in 2009 elsewhere,
-        # and because the library behavior is consistent with this time period
-        case EGGApp.PIKMIN1 | EGGApp.PIKMIN2:
-            return "200903L"
-        case EGGApp.WFP:
-            return "200910L"
-        case EGGApp.NSMBW:
-            return "200911L"
-        case EGGApp.WSR:
-            return "201006L"
-        case EGGApp.LOZ_SS:
-            return "201111L"
-        case _:
-            raise ValueError("Version number must correspond to EGGApp entry")
-
-
-# Specifies linker version per game
-def get_config_linker_version(version_num: int) -> str:
-    match version_num:
-        # AC_CF and WF's linker version isn't known. Guess based on build strings
-        case EGGApp.OGWS | EGGApp.WP | EGGApp.BBA_WD | EGGApp.WF | EGGApp.AC_CF | EGGApp.PIKMIN1 | EGGApp.PIKMIN2:
-            return "GC/3.0a5.2"
-        case EGGApp.MKW:
-            return "Wii/0x4201_127"
-        case EGGApp.WM | EGGApp.WFP | EGGApp.NSMBW | EGGApp.WSR:
-            return "Wii/1.1"
-        case EGGApp.LOZ_SS:
-            return "Wii/1.5"
-        case _:
-            raise ValueError("Version number must correspond to EGGApp entry")
-
-
-# Specifies compiler flags per game
-def get_egg_compiler_flags(version_num: int) -> List[str]:
-    base_flags = [
-        "-nodefaults",
-        "-proc gekko",
-        "-align powerpc",
-        "-enum int",
-        "-fp hardware",
-        "-Cpp_exceptions off",
-        # "-W all",
-        "-O4,p",
-        "-inline auto",
-        '-pragma "cats off"',
-        '-pragma "warn_notinlined off"',
-        "-maxerrors 1",
-        "-nosyspath",
-        "-RTTI off",
-        "-fp_contract on",
-        "-str reuse",
-        "-enc SJIS",
-        "-i include",
-        f"-i build/{config.version}/include",
-        f"-DEGG_VERSION={get_build_version_number(version_num)}",
-        f"-DVERSION_{config.version}",
-    ]
-
-    match version_num:
-        case (
-            EGGApp.OGWS
-            | EGGApp.WP
-            | EGGApp.BBA_WD
-            | EGGApp.WF
-            | EGGApp.WM
-            | EGGApp.PIKMIN1
-            | EGGApp.PIKMIN2
-            | EGGApp.WFP
-            | EGGApp.NSMBW
-            | EGGApp.WSR
-            | EGGApp.LOZ_SS
-        ):
-            return [
-                *base_flags,
-            ]
-        case EGGApp.MKW:
-            return [*base_flags, "-func_align=4"]
-        case EGGApp.AC_CF:
-            return [
-                *base_flags,
-                "-RTTI on",
-            ]
-        case _:
-            raise ValueError("Version number must correspond to EGGApp entry")
+    OGWS = VERSION_INDICES["RSPE01"]
+    WP = VERSION_INDICES["RHAE01"]
+    BBA_WD = VERSION_INDICES["RYWE01"]
+    MKW = VERSION_INDICES["RMCP01"]
+    WF = VERSION_INDICES["RFNE01"]
+    WM = VERSION_INDICES["R64E01"]
+    AC_CF = VERSION_INDICES["RUUE01"]
+    PIKMIN1 = VERSION_INDICES["R9IE01"]
+    PIKMIN2 = VERSION_INDICES["R92E01"]
+    WFP = VERSION_INDICES["RFPE01"]
+    NSMBW = VERSION_INDICES["SMNP01"]
+    WSR = VERSION_INDICES["RZTE01"]
+    LOZ_SS = VERSION_INDICES["SOUE01"]
+
+
+# Per-game EGG configuration
+class EGGAppConfig(NamedTuple):
+    build_version: str  # Year/month for EGG_VERSION
+    linker_version: str  # mwld version
+    extra_cflags: Tuple[str, ...] = ()  # Additional EGG compiler flags
+
+
+GC_LINKER = "GC/3.0a5.2"
+WII_LINKER = "Wii/1.1"
+
+APP_CONFIGS: Dict[int, EGGAppConfig] = {
+    EGGApp.OGWS: EGGAppConfig("200611L", GC_LINKER),
+    EGGApp.WP: EGGAppConfig("200702L", GC_LINKER),
+    EGGApp.BBA_WD: EGGAppConfig("200704L", GC_LINKER),
+    EGGApp.MKW: EGGAppConfig("200804L", "Wii/0x4201_127", ("-func_align=4",)),
+    # AC_CF and WF's linker version isn't known. Guess based on build strings
+    EGGApp.WF: EGGAppConfig("200805L", GC_LINKER),
+    EGGApp.WM: EGGAppConfig("200810L", WII_LINKER),
+    EGGApp.AC_CF: EGGAppConfig("200811L", GC_LINKER, ("-RTTI on",)),
+    # Pikmin 2 is weird. It was released in USA in 2012
+    # However, we use the 2009 build date due to it both releasing in 2009 elsewhere,
+    # and because the library behavior is consistent with this time period
+    EGGApp.PIKMIN1: EGGAppConfig("200903L", GC_LINKER),
+    EGGApp.PIKMIN2: EGGAppConfig("200903L", GC_LINKER),
+    EGGApp.WFP: EGGAppConfig("200910L", WII_LINKER),
+    EGGApp.NSMBW: EGGAppConfig("200911L", WII_LINKER),
+    EGGApp.WSR: EGGAppConfig("201006L", WII_LINKER),
+    EGGApp.LOZ_SS: EGGAppConfig("201111L", "Wii/1.5"),
+}
+
+
+def get_app_config(version_num: int) -> EGGAppConfig:
+    if version_num not in APP_CONFIGS:
+        raise ValueError("Version number must correspond to EGGApp entry")
+    return APP_CONFIGS[version_num]
 
 
 parser = argparse.ArgumentParser()
@@ -211,7 +155,7 @@ parser.add_argument(
     action="store_true",
     help="build with debug info (non-matching)",
 )
-if not is_windows():
+if not IS_WINDOWS:
     parser.add_argument(
         "--wrapper",
         metavar="BINARY",
@@ -253,11 +197,22 @@ parser.add_argument(
     action="store_false",
     help="disable progress calculation",
 )
+parser.add_argument(
+    "--build",
+    action="store_true",
+    help="run ninja after configuring, with jobs and load limit based on CPU count",
+)
 args = parser.parse_args()
 
+# Keep --build out of the arguments recorded in build.ninja,
+# so ninja does not run itself again when re-configuring
+if args.build:
+    sys.argv = [arg for arg in sys.argv if arg != "--build"]
+
 config = ProjectConfig()
-config.version = str(args.version)
-version_num = VERSIONS.index(config.version)
+config.version = args.version
+version_num = VERSION_INDICES[config.version]
+app_config = get_app_config(version_num)
 
 # Apply arguments
 config.build_dir = args.build_dir
@@ -269,7 +224,7 @@ config.generate_map = args.map
 config.non_matching = args.non_matching
 config.sjiswrap_path = args.sjiswrap
 config.progress = args.progress
-if not is_windows():
+if not IS_WINDOWS:
     config.wrapper = args.wrapper
 # Don't build asm unless we're --non-matching
 if not config.non_matching:
@@ -284,8 +239,9 @@ config.sjiswrap_tag = "v1.2.0"
 config.wibo_tag = "0.6.11"
 
 # Project
-config.config_path = Path("config") / config.version / "config.yml"
-config.check_sha_path = Path("config") / config.version / "build.sha1"
+version_config_dir = CONFIG_DIR / config.version
+config.config_path = version_config_dir / "config.yml"
+config.check_sha_path = version_config_dir / "build.sha1"
 config.asflags = [
     "-mgekko",
     "--strip-local-absolute",
@@ -312,7 +268,8 @@ config.scratch_preset_id = None
 
 # Base flags, common to most GC/Wii games.
 # Generally leave untouched, with overrides added below.
-cflags_base = [
+# Flag sets are built once and shared by reference between libraries.
+cflags_common = (
     "-nodefaults",
     "-proc gekko",
     "-align powerpc",
@@ -332,56 +289,73 @@ cflags_base = [
     "-enc SJIS",
     "-i include",
     f"-i build/{config.version}/include",
-    f"-DVERSION_{config.version}",
-]
+)
+
+# Version define, shared by the base and EGG flag sets
+cflags_version = f"-DVERSION_{config.version}"
 
 # Debug flags
 if args.debug:
     # Or -sym dwarf-2 for Wii compilers
-    cflags_base.extend(["-sym on", "-DDEBUG=1"])
+    cflags_debug = ("-sym on", "-DDEBUG=1")
 else:
-    cflags_base.append("-DNDEBUG=1")
+    cflags_debug = ("-DNDEBUG=1",)
+
+cflags_base = (
+    *cflags_common,
+    cflags_version,
+    *cflags_debug,
+)
 
 # Metrowerks library flags
-cflags_runtime = [
-    *cflags_base,
+cflags_runtime = cflags_base + (
     "-use_lmw_stmw on",
     "-str reuse,pool,readonly",
     "-gccinc",
     "-common off",
     "-inline auto",
-]
+)
 
 # REL flags
-cflags_rel = [
-    *cflags_base,
+cflags_rel = cflags_base + (
     "-sdata 0",
     "-sdata2 0",
-]
+)
+
+# EGG library flags
+cflags_egg = cflags_common + (
+    f"-DEGG_VERSION={app_config.build_version}",
+    cflags_version,
+    *app_config.extra_cflags,
+)
 
-config.linker_version = get_config_linker_version(version_num)
+config.linker_version = app_config.linker_version
 
 
 # Helper function for Dolphin libraries
-def DolphinLib(lib_name: str, objects: List[Object]) -> Dict[str, Any]:
-    return {
-        "lib": lib_name,
-        "mw_version": "GC/1.2.5n",
-        "cflags": cflags_base,
-        "progress_category": "sdk",
-        "objects": objects,
-    }
+def DolphinLib(lib_name: str, objects: List[Object]) -> Mapping[str, Any]:
+    return MappingProxyType(
+        {
+            "lib": lib_name,
+            "mw_version": "GC/1.2.5n",
+            "cflags": cflags_base,
+            "progress_category": "sdk",
+            "objects": objects,
+        }
+    )
 
 
 # Helper function for REL script objects
-def Rel(lib_name: str, objects: List[Object]) -> Dict[str, Any]:
-    return {
-        "lib": lib_name,
-        "mw_version": "GC/1.3.2",
-        "cflags": cflags_rel,
-        "progress_category": "game",
-        "objects": objects,
-    }
+def Rel(lib_name: str, objects: List[Object]) -> Mapping[str, Any]:
+    return MappingProxyType(
+        {
+            "lib": lib_name,
+            "mw_version": "GC/1.3.2",
+            "cflags": cflags_rel,
+            "progress_category": "game",
+            "objects": objects,
+        }
+    )
 
 
 Matching = True  # Object matches and should be linked
@@ -398,26 +372,31 @@ def MatchingFor(*versions):
 
 config.warn_missing_config = True
 config.warn_missing_source = False
+# Libraries are read-only, so flag sets and object lists stay shared
 config.libs = [
-    {
-        "lib": "Runtime.PPCEABI.H",
-        "mw_version": config.linker_version,
-        "cflags": cflags_runtime,
-        "progress_category": "sdk",  # str | List[str]
-        "objects": [
-            Object(NonMatching, "Runtime.PPCEABI.H/global_destructor_chain.c"),
-            Object(NonMatching, "Runtime.PPCEABI.H/__init_cpp_exceptions.cpp"),
-        ],
-    },
-    {
-        "lib": "EGG",
-        "mw_version": config.linker_version,
-        "cflags": get_egg_compiler_flags(version_num),
-        "progress_category": "egg",
-        "objects": [
-            Object(Matching, "egg/core/eggDisposer.cpp"),
-        ],
-    },
+    MappingProxyType(
+        {
+            "lib": "Runtime.PPCEABI.H",
+            "mw_version": config.linker_version,
+            "cflags": cflags_runtime,
+            "progress_category": "sdk",  # str | List[str]
+            "objects": [
+                Object(NonMatching, "Runtime.PPCEABI.H/global_destructor_chain.c"),
+                Object(NonMatching, "Runtime.PPCEABI.H/__init_cpp_exceptions.cpp"),
+            ],
+        }
+    ),
+    MappingProxyType(
+        {
+            "lib": "EGG",
+            "mw_version": config.linker_version,
+            "cflags": cflags_egg,
+            "progress_category": "egg",
+            "objects": [
+                Object(Matching, "egg/core/eggDisposer.cpp"),
+            ],
+        }
+    ),
 ]
 
 
@@ -450,6 +429,17 @@ config.progress_each_module = args.verbose
 if args.mode == "configure":
     # Write build.ninja and objdiff.json
     generate_build(config)
+    if args.build:
+        # Replace this process with ninja
+        jobs = os.cpu_count() or 1
+        ninja_args = ["ninja", "-j", str(jobs), "-l", str(int(jobs * 1.5))]
+        # execvp does not flush Python's stdio buffers
+        sys.stdout.flush()
+        sys.stderr.flush()
+        try:
+            os.execvp("ninja", ninja_args)
+        except OSError as e:
+            sys.exit(f"Failed to run ninja: {e}")
 elif args.mode == "progress":
     # Print progress and write progress.json
     calculate_progress(config)
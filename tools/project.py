@@ -10,12 +10,15 @@
 # https://github.com/encounter/dtk-template
 ###
 
+import hashlib
 import io
 import json
 import math
 import os
 import platform
+import shutil
 import sys
+from dataclasses import dataclass, field, fields
 from pathlib import Path
 from typing import (
     Any,
@@ -25,7 +28,9 @@ from typing import (
     IO,
     Iterable,
     List,
+    Mapping,
     Optional,
+    Sequence,
     Set,
     Tuple,
     TypedDict,
@@ -42,10 +47,22 @@ if sys.platform == "cygwin":
         f"\n(Current path: {sys.executable})"
     )
 
-Library = Dict[str, Any]
+Library = Mapping[str, Any]
 
 
 class Object:
+    __slots__ = (
+        "name",
+        "completed",
+        "options",
+        "src_path",
+        "asm_path",
+        "src_obj_path",
+        "asm_obj_path",
+        "host_obj_path",
+        "ctx_path",
+    )
+
     def __init__(self, completed: bool, name: str, **options: Any) -> None:
         self.name = name
         self.completed = completed
@@ -132,88 +149,94 @@ class ProgressCategory:
         self.name = name
 
 
+@dataclass(slots=True)
 class ProjectConfig:
-    def __init__(self) -> None:
-        # Paths
-        self.build_dir: Path = Path("build")  # Output build files
-        self.src_dir: Path = Path("src")  # C/C++/asm source files
-        self.tools_dir: Path = Path("tools")  # Python scripts
-        self.asm_dir: Optional[Path] = Path(
-            "asm"
-        )  # Override incomplete objects (for modding)
-
-        # Tooling
-        self.binutils_tag: Optional[str] = None  # Git tag
-        self.binutils_path: Optional[Path] = None  # If None, download
-        self.dtk_tag: Optional[str] = None  # Git tag
-        self.dtk_path: Optional[Path] = None  # If None, download
-        self.compilers_tag: Optional[str] = None  # 1
-        self.compilers_path: Optional[Path] = None  # If None, download
-        self.wibo_tag: Optional[str] = None  # Git tag
-        self.wrapper: Optional[Path] = None  # If None, download wibo on Linux
-        self.sjiswrap_tag: Optional[str] = None  # Git tag
-        self.sjiswrap_path: Optional[Path] = None  # If None, download
-        self.objdiff_tag: Optional[str] = None  # Git tag
-        self.objdiff_path: Optional[Path] = None  # If None, download
-
-        # Project config
-        self.non_matching: bool = False
-        self.build_rels: bool = True  # Build REL files
-        self.check_sha_path: Optional[Path] = None  # Path to version.sha1
-        self.config_path: Optional[Path] = None  # Path to config.yml
-        self.generate_map: bool = False  # Generate map file(s)
-        self.asflags: Optional[List[str]] = None  # Assembler flags
-        self.ldflags: Optional[List[str]] = None  # Linker flags
-        self.libs: Optional[List[Library]] = None  # List of libraries
-        self.linker_version: Optional[str] = None  # mwld version
-        self.version: Optional[str] = None  # Version name
-        self.warn_missing_config: bool = False  # Warn on missing unit configuration
-        self.warn_missing_source: bool = False  # Warn on missing source file
-        self.rel_strip_partial: bool = True  # Generate PLFs with -strip_partial
-        self.rel_empty_file: Optional[str] = (
-            None  # Object name for generating empty RELs
-        )
-        self.shift_jis = (
-            True  # Convert source files from UTF-8 to Shift JIS automatically
-        )
-        self.reconfig_deps: Optional[List[Path]] = (
-            None  # Additional re-configuration dependency files
-        )
-        self.custom_build_rules: Optional[List[Dict[str, Any]]] = (
-            None  # Custom ninja build rules
-        )
-        self.custom_build_steps: Optional[Dict[str, List[Dict[str, Any]]]] = (
-            None  # Custom build steps, types are ["pre-compile", "post-compile", "post-link", "post-build"]
-        )
-        self.generate_compile_commands: bool = (
-            True  # Generate compile_commands.json for clangd
-        )
-        self.extra_clang_flags: List[str] = []  # Extra flags for clangd
-        self.scratch_preset_id: Optional[int] = (
-            None  # Default decomp.me preset ID for scratches
-        )
-        self.link_order_callback: Optional[Callable[[int, List[str]], List[str]]] = (
-            None  # Callback to add/remove/reorder units within a module
-        )
+    # Paths
+    build_dir: Path = Path("build")  # Output build files
+    src_dir: Path = Path("src")  # C/C++/asm source files
+    tools_dir: Path = Path("tools")  # Python scripts
+    asm_dir: Optional[Path] = Path("asm")  # Override incomplete objects (for modding)
 
-        # Progress output, progress.json and report.json config
-        self.progress = True  # Enable report.json generation and CLI progress output
-        self.progress_all: bool = True  # Include combined "all" category
-        self.progress_modules: bool = True  # Include combined "modules" category
-        self.progress_each_module: bool = (
-            False  # Include individual modules, disable for large numbers of modules
-        )
-        self.progress_categories: List[ProgressCategory] = []  # Additional categories
-        self.print_progress_categories: Union[bool, List[str]] = (
-            True  # Print additional progress categories in the CLI progress output
-        )
+    # Tooling
+    binutils_tag: Optional[str] = None  # Git tag
+    binutils_path: Optional[Path] = None  # If None, download
+    dtk_tag: Optional[str] = None  # Git tag
+    dtk_path: Optional[Path] = None  # If None, download
+    compilers_tag: Optional[str] = None  # 1
+    compilers_path: Optional[Path] = None  # If None, download
+    wibo_tag: Optional[str] = None  # Git tag
+    wrapper: Optional[Path] = None  # If None, download wibo on Linux
+    sjiswrap_tag: Optional[str] = None  # Git tag
+    sjiswrap_path: Optional[Path] = None  # If None, download
+    objdiff_tag: Optional[str] = None  # Git tag
+    objdiff_path: Optional[Path] = None  # If None, download
+
+    # Project config
+    non_matching: bool = False
+    build_rels: bool = True  # Build REL files
+    check_sha_path: Optional[Path] = None  # Path to version.sha1
+    config_path: Optional[Path] = None  # Path to config.yml
+    generate_map: bool = False  # Generate map file(s)
+    asflags: Optional[List[str]] = None  # Assembler flags
+    ldflags: Optional[List[str]] = None  # Linker flags
+    libs: Optional[List[Library]] = None  # List of libraries
+    linker_version: Optional[str] = None  # mwld version
+    version: Optional[str] = None  # Version name
+    warn_missing_config: bool = False  # Warn on missing unit configuration
+    warn_missing_source: bool = False  # Warn on missing source file
+    rel_strip_partial: bool = True  # Generate PLFs with -strip_partial
+    rel_empty_file: Optional[str] = (
+        None  # Object name for generating empty RELs
+    )
+    shift_jis: bool = (
+        True  # Convert source files from UTF-8 to Shift JIS automatically
+    )
+    reconfig_deps: Optional[List[Path]] = (
+        None  # Additional re-configuration dependency files
+    )
+    custom_build_rules: Optional[List[Dict[str, Any]]] = (
+        None  # Custom ninja build rules
+    )
+    custom_build_steps: Optional[Dict[str, List[Dict[str, Any]]]] = (
+        None  # Custom build steps, types are ["pre-compile", "post-compile", "post-link", "post-build"]
+    )
+    generate_compile_commands: bool = (
+        True  # Generate compile_commands.json for clangd
+    )
+    extra_clang_flags: List[str] = field(default_factory=list)  # Extra flags for clangd
+    scratch_preset_id: Optional[int] = (
+        None  # Default decomp.me preset ID for scratches
+    )
+    link_order_callback: Optional[Callable[[int, List[str]], List[str]]] = (
+        None  # Callback to add/remove/reorder units within a module
+    )
+    compile_pool_depth: Optional[int] = (
+        os.cpu_count()  # Max parallel MWCC jobs, or None for no limit
+    )
+    link_pool_depth: Optional[int] = (
+        1  # Max parallel MWLD jobs, or None for no limit
+    )
 
-        # Progress fancy printing
-        self.progress_use_fancy: bool = False
-        self.progress_code_fancy_frac: int = 0
-        self.progress_code_fancy_item: str = ""
-        self.progress_data_fancy_frac: int = 0
-        self.progress_data_fancy_item: str = ""
+    # Progress output, progress.json and report.json config
+    progress: bool = True  # Enable report.json generation and CLI progress output
+    progress_all: bool = True  # Include combined "all" category
+    progress_modules: bool = True  # Include combined "modules" category
+    progress_each_module: bool = (
+        False  # Include individual modules, disable for large numbers of modules
+    )
+    progress_categories: List[ProgressCategory] = field(
+        default_factory=list
+    )  # Additional categories
+    print_progress_categories: Union[bool, List[str]] = (
+        True  # Print additional progress categories in the CLI progress output
+    )
+
+    # Progress fancy printing
+    progress_use_fancy: bool = False
+    progress_code_fancy_frac: int = 0
+    progress_code_fancy_item: str = ""
+    progress_data_fancy_frac: int = 0
+    progress_data_fancy_item: str = ""
 
     def validate(self) -> None:
         required_attrs = [
@@ -304,7 +327,17 @@ def file_is_c_cpp(path: Path) -> bool:
     return file_is_c(path) or file_is_cpp(path)
 
 
-def make_flags_str(flags: Optional[List[str]]) -> str:
+# Writes a whole file at once, replacing it atomically
+# so readers (such as ninja) never see a partially written file
+def write_file(path: Path, data: str) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def make_flags_str(flags: Optional[Sequence[str]]) -> str:
     if flags is None:
         return ""
     return " ".join(flags)
@@ -386,14 +419,142 @@ def load_build_config(
     return build_config
 
 
+# Files that cause a re-configure when modified
+def configure_deps(config: ProjectConfig) -> List[Path]:
+    configure_script = Path(os.path.relpath(os.path.abspath(sys.argv[0])))
+    python_lib = Path(os.path.relpath(__file__))
+    deps = [
+        configure_script,
+        python_lib,
+        python_lib.parent / "ninja_syntax.py",
+    ]
+    if config.config_path is not None:
+        deps.append(config.config_path)
+    deps.extend(config.reconfig_deps or [])
+    return deps
+
+
+# Hash every input that affects the generated build files
+def build_stamp(config: ProjectConfig, objects: Dict[str, Object]) -> str:
+    def mtime(path: Path) -> Optional[int]:
+        return path.stat().st_mtime_ns if path.exists() else None
+
+    def default_format(o: Any) -> Any:
+        if isinstance(o, Object):
+            return [o.name, o.completed, o.options]
+        if isinstance(o, ProgressCategory):
+            return vars(o)
+        if isinstance(o, Mapping):
+            return dict(o)
+        if callable(o):
+            return getattr(o, "__qualname__", str(o))
+        return str(o)
+
+    inputs = {
+        "argv": sys.argv,
+        "python": sys.executable,
+        "config": {f.name: getattr(config, f.name) for f in fields(config)},
+        "deps": [
+            mtime(path)
+            for path in [
+                config.out_path() / "config.json",
+                *configure_deps(config),
+            ]
+        ],
+        "sources": [
+            [
+                obj.src_path is not None and obj.src_path.exists(),
+                obj.asm_path is not None and obj.asm_path.exists(),
+            ]
+            for obj in objects.values()
+        ],
+    }
+    data = json.dumps(inputs, sort_keys=True, default=default_format)
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+
+# Stamps hold the input hash on the first line,
+# followed by the warnings printed when the files were generated
+def read_stamp(path: Path) -> Tuple[Optional[str], List[str]]:
+    if not path.is_file():
+        return None, []
+    lines = path.read_text(encoding="utf-8").splitlines()
+    if len(lines) == 0:
+        return None, []
+    return lines[0], lines[1:]
+
+
+def write_stamp(path: Path, stamp: str, warnings: List[str]) -> None:
+    write_file(path, "\n".join([stamp, *warnings]) + "\n")
+
+
 # Generate build.ninja, objdiff.json and compile_commands.json
 def generate_build(config: ProjectConfig) -> None:
     config.validate()
     objects = config.objects()
+
+    # Skip regeneration if nothing changed since the last run
+    # Stored next to build.ninja, since it is shared by all build directories
+    stamp_path = Path(".configure.stamp")
+    stamp = build_stamp(config, objects)
+    outputs = [Path("build.ninja"), config.build_dir / "build.ninja.d"]
+    if (config.out_path() / "config.json").is_file():
+        outputs.append(Path("objdiff.json"))
+        if config.generate_compile_commands:
+            outputs.append(Path("compile_commands.json"))
+    last_stamp, last_warnings = read_stamp(stamp_path)
+    if all(path.is_file() for path in outputs) and last_stamp == stamp:
+        # Still update the mtime, so ninja sees build.ninja as up to date
+        # when it re-runs the configure step
+        os.utime("build.ninja")
+        # Repeat the warnings from the run that generated the files
+        for warning in last_warnings:
+            print(warning)
+        return
+
+    # Generated files cached per version, restored when switching back to
+    # a version whose inputs are unchanged
+    cache_dir = config.out_path() / "configure"
+    cache_stamp_path = cache_dir / "stamp"
+    cached_files = [
+        Path("build.ninja"),
+        config.build_dir / "build.ninja.d",
+        Path("compile_commands.json"),
+    ]
+
     build_config = load_build_config(config, config.out_path() / "config.json")
-    generate_build_ninja(config, objects, build_config)
-    generate_objdiff_config(config, objects, build_config)
-    generate_compile_commands(config, objects, build_config)
+    # Only files generated by this run are cached, not leftovers from other versions
+    generated_files = [Path("build.ninja"), config.build_dir / "build.ninja.d"]
+    if build_config is not None and config.generate_compile_commands:
+        generated_files.append(Path("compile_commands.json"))
+    cache_stamp, warnings = read_stamp(cache_stamp_path)
+    if cache_stamp == stamp and all(
+        (cache_dir / path.name).is_file() for path in generated_files
+    ):
+        for path in generated_files:
+            write_file(path, (cache_dir / path.name).read_text(encoding="utf-8"))
+    else:
+        warnings = generate_build_ninja(config, objects, build_config)
+        generate_compile_commands(config, objects, build_config)
+        # Remove the stamp first and write it last,
+        # so an interrupted run never leaves new files under an old stamp
+        if cache_stamp_path.is_file():
+            os.remove(cache_stamp_path)
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        for path in cached_files:
+            cache_path = cache_dir / path.name
+            if path in generated_files:
+                shutil.copyfile(path, cache_path)
+            elif cache_path.is_file():
+                os.remove(cache_path)
+        write_stamp(cache_stamp_path, stamp, warnings)
+    # Always regenerated, to keep symbol mappings from the existing objdiff.json
+    warnings = warnings + generate_objdiff_config(config, objects, build_config)
+    for warning in warnings:
+        print(warning)
+
+    # Write the stamp last, so an interrupted run regenerates next time
+    write_stamp(stamp_path, stamp, warnings)
 
 
 # Generate build.ninja
@@ -401,7 +562,10 @@ def generate_build_ninja(
     config: ProjectConfig,
     objects: Dict[str, Object],
     build_config: Optional[BuildConfig],
-) -> None:
+) -> List[str]:
+    # Warnings are returned to the caller, which prints them and saves them
+    # with the configure stamp
+    warnings: List[str] = []
     out = io.StringIO()
     n = ninja_syntax.Writer(out)
     n.variable("ninja_required_version", "1.3")
@@ -409,7 +573,6 @@ def generate_build_ninja(
 
     configure_script = Path(os.path.relpath(os.path.abspath(sys.argv[0])))
     python_lib = Path(os.path.relpath(__file__))
-    python_lib_dir = python_lib.parent
     n.comment("The arguments passed to configure.py, for rerunning it.")
     n.variable("configure_args", sys.argv[1:])
     n.variable("python", f'"{sys.executable}"')
@@ -635,11 +798,23 @@ def generate_build_ninja(
         mwcc_implicit.append(transform_dep)
         mwcc_sjis_implicit.append(transform_dep)
 
+    # Limit parallelism of memory-heavy compiler and linker jobs
+    compile_pool: Optional[str] = None
+    if config.compile_pool_depth is not None:
+        compile_pool = "mwcc_compile"
+        n.pool(compile_pool, config.compile_pool_depth)
+    link_pool: Optional[str] = None
+    if config.link_pool_depth is not None:
+        link_pool = "link"
+        n.pool(link_pool, config.link_pool_depth)
+    n.newline()
+
     n.comment("Link ELF file")
     n.rule(
         name="link",
         command=mwld_cmd,
         description="LINK $out",
+        pool=link_pool,
         rspfile="$out.rsp",
         rspfile_content="$in_newline",
     )
@@ -658,6 +833,7 @@ def generate_build_ninja(
         name="mwcc",
         command=mwcc_cmd,
         description="MWCC $out",
+        pool=compile_pool,
         depfile="$basefile.d",
         deps="gcc",
     )
@@ -668,6 +844,7 @@ def generate_build_ninja(
         name="mwcc_sjis",
         command=mwcc_sjis_cmd,
         description="MWCC $out",
+        pool=compile_pool,
         depfile="$basefile.d",
         deps="gcc",
     )
@@ -851,6 +1028,18 @@ def generate_build_ninja(
         host_source_inputs: List[Path] = []
         source_added: Set[Path] = set()
 
+        # Shared cflags sets are written once as top-level variables,
+        # keeping repeated flag strings out of each build edge
+        cflags_vars: Dict[str, str] = {}
+
+        def cflags_var(cflags_str: str) -> str:
+            name = cflags_vars.get(cflags_str)
+            if name is None:
+                name = f"cflags_{len(cflags_vars)}"
+                cflags_vars[cflags_str] = name
+                n.variable(name, cflags_str)
+            return f"${name}"
+
         def c_build(obj: Object, src_path: Path) -> Optional[Path]:
             # Avoid creating duplicate build rules
             if obj.src_obj_path is None or obj.src_obj_path in source_added:
@@ -873,8 +1062,10 @@ def generate_build_ninja(
                 else:
                     extra_cflags.insert(0, "-lang=c")
 
-            all_cflags = cflags + extra_cflags
-            cflags_str = make_flags_str(all_cflags)
+            all_cflags = [*cflags, *extra_cflags]
+            cflags_str = make_flags_str(
+                [cflags_var(make_flags_str(cflags)), *extra_cflags]
+            )
             used_compiler_versions.add(obj.options["mw_version"])
 
             # Add MWCC build rule
@@ -974,7 +1165,7 @@ def generate_build_ninja(
             obj = objects.get(obj_name)
             if obj is None:
                 if config.warn_missing_config and not build_obj["autogenerated"]:
-                    print(f"Missing configuration for {obj_name}")
+                    warnings.append(f"Missing configuration for {obj_name}")
                 if obj_path is not None:
                     link_step.add(Path(obj_path))
                 return
@@ -992,7 +1183,7 @@ def generate_build_ninja(
                     sys.exit(f"Unknown source file type {obj.src_path}")
             else:
                 if config.warn_missing_source or obj.completed:
-                    print(f"Missing source file {obj.src_path}")
+                    warnings.append(f"Missing source file {obj.src_path}")
                 link_built_obj = False
 
             # Assembly overrides
@@ -1283,11 +1474,13 @@ def generate_build_ninja(
     # Regenerate on change
     ###
     n.comment("Reconfigure on change")
+    configure_depfile = config.build_dir / "build.ninja.d"
     n.rule(
         name="configure",
         command=f"$python {configure_script} $configure_args",
         generator=True,
         description=f"RUN {configure_script}",
+        depfile=configure_depfile,
     )
     n.build(
         outputs="build.ninja",
@@ -1296,12 +1489,27 @@ def generate_build_ninja(
             build_config_path,
             configure_script,
             python_lib,
-            python_lib_dir / "ninja_syntax.py",
+            python_lib.parent / "ninja_syntax.py",
             *(config.reconfig_deps or []),
         ],
     )
     n.newline()
 
+    # Write all configure inputs as a GCC-style depfile
+    # Missing files are left out: ninja would otherwise re-run configure forever,
+    # while missing explicit inputs above fail with a clear error instead
+    def depfile_path(path: Path) -> str:
+        return serialize_path(path).replace(" ", "\\ ")
+
+    write_file(
+        configure_depfile,
+        "build.ninja: "
+        + " ".join(
+            depfile_path(path) for path in configure_deps(config) if path.exists()
+        )
+        + "\n",
+    )
+
     ###
     # Default rule
     ###
@@ -1317,9 +1525,9 @@ def generate_build_ninja(
         n.default(build_config_path)
 
     # Write build.ninja
-    with open("build.ninja", "w", encoding="utf-8") as f:
-        f.write(out.getvalue())
+    write_file(Path("build.ninja"), out.getvalue())
     out.close()
+    return warnings
 
 
 # Generate objdiff.json
@@ -1327,9 +1535,10 @@ def generate_objdiff_config(
     config: ProjectConfig,
     objects: Dict[str, Object],
     build_config: Optional[BuildConfig],
-) -> None:
+) -> List[str]:
+    warnings: List[str] = []
     if build_config is None:
-        return
+        return warnings
 
     # Load existing objdiff.json
     existing_units = {}
@@ -1437,7 +1646,7 @@ def generate_objdiff_config(
             )
 
         all_cflags = list(
-            filter(keep_flag, obj.options["cflags"] + obj.options["extra_cflags"])
+            filter(keep_flag, [*obj.options["cflags"], *obj.options["extra_cflags"]])
         )
         reverse_fn_order = False
         for flag in all_cflags:
@@ -1451,7 +1660,9 @@ def generate_objdiff_config(
 
         compiler_version = COMPILER_MAP.get(obj.options["mw_version"])
         if compiler_version is None:
-            print(f"Missing scratch compiler mapping for {obj.options['mw_version']}")
+            warnings.append(
+                f"Missing scratch compiler mapping for {obj.options['mw_version']}"
+            )
         else:
             cflags_str = make_flags_str(all_cflags)
             unit_config["scratch"] = {
@@ -1528,12 +1739,14 @@ def generate_objdiff_config(
             return d
 
     # Write objdiff.json
-    with open("objdiff.json", "w", encoding="utf-8") as w:
+    def unix_path(input: Any) -> str:
+        return str(input).replace(os.sep, "/") if input else ""
 
-        def unix_path(input: Any) -> str:
-            return str(input).replace(os.sep, "/") if input else ""
-
-        json.dump(cleandict(objdiff_config), w, indent=2, default=unix_path)
+    write_file(
+        Path("objdiff.json"),
+        json.dumps(cleandict(objdiff_config), indent=2, default=unix_path),
+    )
+    return warnings
 
 
 def generate_compile_commands(
@@ -1739,14 +1952,15 @@ def generate_compile_commands(
             add_unit(unit)
 
     # Write compile_commands.json
-    with open("compile_commands.json", "w", encoding="utf-8") as w:
-
-        def default_format(o):
-            if isinstance(o, Path):
-                return o.resolve().as_posix()
-            return str(o)
-
-        json.dump(clangd_config, w, indent=2, default=default_format)
+    def default_format(o):
+        if isinstance(o, Path):
+            return o.resolve().as_posix()
+        return str(o)
+
+    write_file(
+        Path("compile_commands.json"),
+        json.dumps(clangd_config, indent=2, default=default_format),
+    )
 
 
 # Calculate, print and write progress to progress.json